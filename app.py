@@ -1,37 +1,66 @@
-from collections import defaultdict, deque
-from datetime import datetime
-from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
 from pathlib import Path
+from typing import Iterable, Iterator
+import bisect
+import hashlib
 import io
+import itertools
 import logging
 import os
 import random
 import re
-import sqlite3
+import textwrap
 import threading
+import time
 
-import bleach
 import google.genai as genai
+from google.genai import types as genai_types
 import markdown
+import nh3
+import orjson
 import requests
 from dotenv import load_dotenv
-from flask import Flask, Response, flash, g, jsonify, redirect, render_template, request, session, url_for
+from flask import Flask, Response, current_app, flash, g, jsonify, redirect, render_template, request, session, url_for
+from flask.json.provider import DefaultJSONProvider
 from pypdf import PdfReader
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
+from requests.adapters import HTTPAdapter
 from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from werkzeug.security import check_password_hash, generate_password_hash
 
+try:
+    # Optional drop-in for a custom (e.g. PGO-optimized) SQLite build.
+    import pysqlite3.dbapi2 as sqlite3
+except ImportError:
+    import sqlite3
+
 load_dotenv()
 
 BASE_DIR = Path(__file__).resolve().parent
 ALLOWED_MODES = {"explain", "summarize", "quiz", "flashcards"}
+# Quiz and flashcard sets should vary between requests, so only these modes are cached.
+CACHEABLE_MODES = {"explain", "summarize"}
 ALLOWED_DIFFICULTIES = {"Easy", "Medium", "Hard"}
 ALLOWED_PROVIDERS = {"gemini", "openrouter"}
 MAX_TOPIC_LENGTH = 2000
+MAX_PDF_TEXT_LENGTH = 12000
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+SQL_UTC_NOW = f"strftime('{TIMESTAMP_FORMAT}', 'now')"
+PASSWORD_HASH_METHOD = "scrypt"
+SESSION_USER_MAX_AGE_SECONDS = 300
+LEADERBOARD_CACHE_SECONDS = 3
+HEALTH_CACHE_SECONDS = 1
+OWNER_PROFILE_CACHE_SECONDS = 30
+AI_RESPONSE_CACHE_SECONDS = 600
+MARKDOWN_ALLOWED_TAGS = {"p", "strong", "em", "ul", "ol", "li", "code", "pre", "blockquote", "h1", "h2", "h3", "h4", "hr", "br"}
 REQUEST_WINDOW_SECONDS = 60
-REQUEST_HISTORY = defaultdict(deque)
-REQUEST_LOCK = threading.Lock()
+RATE_LIMIT_SHARDS = 16
+RATE_LIMIT_MAX_CLIENTS = 50_000
 AVATARS = ["🧙", "🦸", "🧠", "🤖", "🐉", "🦊", "🐼", "👾"]
 XP_RULES = {
     "explain": 8,
@@ -59,17 +88,208 @@ LEVELS = [
     (800, "Platinum", "💠"),
     (1500, "Legend", "👑"),
 ]
+_LEVEL_THRESHOLDS = tuple(threshold for threshold, _, _ in LEVELS)
+_LEVEL_META = tuple((name, icon) for _, name, icon in LEVELS)
+
+OWNER_KEYWORDS = (
+    "kishan",
+    "owner",
+    "creator",
+    "who made",
+    "who built",
+    "about you",
+    "about owner",
+    "about kishan",
+    "linkedin",
+)
+
+# Ordered by priority: the first rule with any keyword found in the message wins.
+FAQ_RULES = (
+    (
+        ("hello", "hi", "hey"),
+        "Hi {username}! 👋 I’m your Study Buddy. Ask me about chat, XP, quiz, PDF, leaderboard, or profile settings.",
+    ),
+    (
+        ("how to use", "how use", "start", "guide", "help"),
+        (
+            "Sure {username}, quick guide:\n"
+            "1) Open AI Chat and enter a prompt.\n"
+            "2) Pick mode (Explain/Summarize/Quiz/Flashcards).\n"
+            "3) Optionally upload PDF and click Analyze PDF.\n"
+            "4) Use Dashboard for stats/history.\n"
+            "5) Use XP Center to track progress and rules."
+        ),
+    ),
+    (
+        ("xp", "points", "level", "badge"),
+        (
+            "{username}, XP is earned on tasks and quiz submits.\n"
+            "- Explain +8\n- Summarize +10\n- Flashcards +12\n- Quiz generate +15\n"
+            "- PDF bonus +5\n- Quiz submit base +20\n- +5 per correct answer"
+        ),
+    ),
+    (
+        ("leaderboard", "rank", "ranking"),
+        "{username}, open Leaderboard from sidebar to see XP ranking. Higher XP means better rank 🏆.",
+    ),
+    (
+        ("quiz", "mcq", "test"),
+        "{username}, select Quiz mode in Chat, generate questions, then submit. You earn extra XP based on correct answers.",
+    ),
+    (
+        ("pdf", "file", "upload"),
+        "{username}, in Chat use the file picker, then click Analyze PDF. You’ll also get PDF bonus XP ✨.",
+    ),
+    (
+        ("theme", "dark", "light", "mode"),
+        "{username}, use the 🌓 Toggle Theme button in the sidebar to switch Dark/Light mode.",
+    ),
+    (
+        ("profile", "password", "avatar"),
+        "{username}, open Profile page to change avatar and password settings.",
+    ),
+)
+
+_HTML_TAG_RE = re.compile(r"<[^>]*>")
+_URL_SCHEME_RE = re.compile(r"^https?://", re.IGNORECASE)
+_OWNER_KEYWORD_RE = re.compile("|".join(map(re.escape, OWNER_KEYWORDS)))
+_FAQ_KEYWORD_RULE = {keyword: idx for idx, (keywords, _) in enumerate(FAQ_RULES) for keyword in keywords}
+# Zero-width lookahead so overlapping keywords are all reported in a single scan.
+_FAQ_KEYWORD_RE = re.compile("(?=(" + "|".join(map(re.escape, _FAQ_KEYWORD_RULE)) + "))")
+
+DASHBOARD_ROW_LIMIT = 30
+
+# Fixed SQL text lets sqlite3's per-connection statement cache reuse the compiled plans.
+DASHBOARD_STATS_SQL = """
+    SELECT
+        COUNT(*) as attempts,
+        COALESCE(SUM(score), 0) as total_score,
+        COALESCE(SUM(total), 0) as total_questions,
+        COALESCE(AVG(CASE WHEN total > 0 THEN (score * 100.0 / total) END), 0) as avg_percent
+    FROM quiz_scores
+    WHERE user_id = ?
+"""
+HISTORY_COLUMNS = ("topic", "score", "total", "difficulty", "provider", "date")
+HISTORY_SQL = """
+    SELECT topic, score, total, difficulty, provider, date
+    FROM quiz_scores
+    WHERE user_id = ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+HISTORY_SEARCH_SQL = """
+    SELECT topic, score, total, difficulty, provider, date
+    FROM quiz_scores
+    WHERE user_id = ? AND topic LIKE ? ESCAPE '\\'
+    ORDER BY id DESC
+    LIMIT ?
+"""
+SCORE_EXPORT_SQL = """
+    SELECT topic, score, total, difficulty, provider, date
+    FROM quiz_scores
+    WHERE user_id = ?
+    ORDER BY id DESC
+"""
+XP_EVENTS_SQL = """
+    SELECT action, points, date
+    FROM xp_events
+    WHERE user_id = ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+LEADERBOARD_SQL = """
+    SELECT
+        username,
+        avatar,
+        xp,
+        1 + (SELECT COUNT(*) FROM users AS ahead WHERE ahead.xp > users.xp) AS rank
+    FROM users
+    ORDER BY xp DESC, id ASC
+    LIMIT ?
+"""
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA wal_autocheckpoint=1000",
+)
+
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries expire ``ttl`` seconds after being stored."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that serializes with orjson, keeping Flask's fallbacks for other types."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 _gemini_client = None
+_http_session = None
+_db_local = threading.local()
+_quote_cycle = itertools.cycle(random.sample(MOTIVATION_QUOTES, len(MOTIVATION_QUOTES)))
+_quote_lock = threading.Lock()
+_rate_limit_locks = [threading.Lock() for _ in range(RATE_LIMIT_SHARDS)]
+_rate_limit_tats = [OrderedDict() for _ in range(RATE_LIMIT_SHARDS)]
+_leaderboard_cache = TTLCache(maxsize=8, ttl=LEADERBOARD_CACHE_SECONDS)
+_db_health_cache = TTLCache(maxsize=1, ttl=HEALTH_CACHE_SECONDS)
+_owner_profile_cache = TTLCache(maxsize=1024, ttl=OWNER_PROFILE_CACHE_SECONDS)
+_ai_response_cache = TTLCache(maxsize=1024, ttl=AI_RESPONSE_CACHE_SECONDS)
 
 
 def create_app() -> Flask:
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)
     app.config.update(
         SECRET_KEY=os.getenv("FLASK_SECRET_KEY", "change-me-in-production"),
         DATABASE_PATH=str(BASE_DIR / os.getenv("DATABASE_FILE", "database.db")),
         REQUEST_TIMEOUT=int(os.getenv("REQUEST_TIMEOUT", "25")),
         RATE_LIMIT_PER_MINUTE=int(os.getenv("RATE_LIMIT_PER_MINUTE", "45")),
+        AI_RESPONSE_BUDGET=int(os.getenv("AI_RESPONSE_BUDGET", "50")),
+        # Defaults to the gunicorn thread count so every request thread can have an AI call in flight.
+        AI_MAX_WORKERS=int(os.getenv("AI_MAX_WORKERS", os.getenv("GUNICORN_THREADS", "16"))),
         MAX_CONTENT_LENGTH=8 * 1024 * 1024,
         JSON_SORT_KEYS=False,
     )
@@ -79,18 +299,60 @@ def create_app() -> Flask:
         format="%(asctime)s %(levelname)s %(name)s - %(message)s",
     )
 
+    app.extensions["ai_executor"] = ThreadPoolExecutor(
+        max_workers=app.config["AI_MAX_WORKERS"],
+        thread_name_prefix="ai",
+    )
+
     init_db(app)
     register_hooks(app)
     register_routes(app)
+
+    # Compile templates at boot so the first request to each page skips the Jinja compile step.
+    for template_name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(template_name)
     return app
 
 
 def get_db_connection(app: Flask) -> sqlite3.Connection:
     conn = sqlite3.connect(app.config["DATABASE_PATH"])
     conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
+def get_db() -> sqlite3.Connection:
+    """Return this thread's connection, kept open across requests and opened on first use."""
+    if "db" not in g:
+        connections = getattr(_db_local, "connections", None)
+        if connections is None:
+            connections = _db_local.connections = {}
+        path = current_app.config["DATABASE_PATH"]
+        if path not in connections:
+            connections[path] = get_db_connection(current_app)
+        g.db = connections[path]
+    return g.db
+
+
+def release_db(_exc=None) -> None:
+    conn = g.pop("db", None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+@contextmanager
+def write_transaction(conn: sqlite3.Connection):
+    """Take the write lock up front so concurrent writers wait on busy_timeout instead of deadlocking."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
 def init_db(app: Flask) -> None:
     conn = get_db_connection(app)
     cursor = conn.cursor()
@@ -107,7 +369,7 @@ def init_db(app: Flask) -> None:
         """
     )
     cursor.execute(
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS quiz_scores (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -116,19 +378,19 @@ def init_db(app: Flask) -> None:
             total INTEGER NOT NULL,
             difficulty TEXT NOT NULL,
             provider TEXT,
-            date TEXT NOT NULL,
+            date TEXT NOT NULL DEFAULT ({SQL_UTC_NOW}),
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
         """
     )
     cursor.execute(
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS xp_events (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             action TEXT NOT NULL,
             points INTEGER NOT NULL,
-            date TEXT NOT NULL,
+            date TEXT NOT NULL DEFAULT ({SQL_UTC_NOW}),
             FOREIGN KEY(user_id) REFERENCES users(id)
         )
         """
@@ -173,14 +435,22 @@ def init_db(app: Flask) -> None:
         cursor.execute("ALTER TABLE quiz_scores ADD COLUMN user_id INTEGER")
 
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_quiz_scores_date ON quiz_scores(date DESC)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_quiz_scores_user_id ON quiz_scores(user_id)")
+    cursor.execute("DROP INDEX IF EXISTS idx_quiz_scores_user_id")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_quiz_scores_user_id_id ON quiz_scores(user_id, id DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_xp_events_user_id_id ON xp_events(user_id, id DESC)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_xp ON users(xp DESC)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_owner_profiles_user_id ON owner_profiles(user_id)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_profiles_user_id ON user_profiles(user_id)")
     conn.commit()
+    conn.execute("PRAGMA analysis_limit=400")
+    conn.execute("ANALYZE")
     conn.close()
 
 
+def utc_timestamp() -> str:
+    return datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
 def login_required(view):
     @wraps(view)
     def wrapped_view(*args, **kwargs):
@@ -191,104 +461,118 @@ def login_required(view):
     return wrapped_view
 
 
+def remember_session_user(user) -> dict:
+    """Store the signed user snapshot that load_logged_user serves without a query."""
+    snapshot = {key: user[key] for key in ("id", "username", "avatar", "xp")}
+    session["user"] = snapshot
+    session["user_ts"] = int(time.time())
+    return snapshot
+
+
 def get_current_user(app: Flask):
     user_id = session.get("user_id")
     if not user_id:
         return None
 
-    conn = get_db_connection(app)
-    user = conn.execute("SELECT id, username, avatar, xp FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
-    return user
+    cached = session.get("user")
+    if (
+        cached
+        and cached.get("id") == user_id
+        and time.time() - session.get("user_ts", 0) < SESSION_USER_MAX_AGE_SECONDS
+    ):
+        return cached
 
+    conn = get_db()
+    user = conn.execute("SELECT id, username, avatar, xp FROM users WHERE id = ?", (user_id,)).fetchone()
+    if not user:
+        session.pop("user", None)
+        return None
+    return remember_session_user(user)
 
-def get_level_info(xp: int):
-    current_name = "Bronze"
-    current_icon = "🥉"
-    next_threshold = None
 
-    for threshold, name, icon in LEVELS:
-        if xp >= threshold:
-            current_name = name
-            current_icon = icon
-        elif next_threshold is None:
-            next_threshold = threshold
+@lru_cache(maxsize=1024)
+def _level_for_xp(xp: int) -> tuple:
+    idx = max(bisect.bisect_right(_LEVEL_THRESHOLDS, xp) - 1, 0)
+    name, icon = _LEVEL_META[idx]
+    next_threshold = _LEVEL_THRESHOLDS[idx + 1] if idx + 1 < len(_LEVEL_THRESHOLDS) else None
 
     progress_to_next = 100
     if next_threshold is not None:
-        previous_threshold = 0
-        for threshold, _, _ in LEVELS:
-            if threshold <= xp:
-                previous_threshold = threshold
+        previous_threshold = _LEVEL_THRESHOLDS[idx]
         span = max(next_threshold - previous_threshold, 1)
         progress_to_next = int(((xp - previous_threshold) / span) * 100)
 
+    return name, icon, next_threshold, max(0, min(progress_to_next, 100))
+
+
+def get_level_info(xp: int):
+    name, icon, next_threshold, progress = _level_for_xp(xp)
     return {
-        "name": current_name,
-        "icon": current_icon,
+        "name": name,
+        "icon": icon,
         "next_threshold": next_threshold,
-        "progress": max(0, min(progress_to_next, 100)),
+        "progress": progress,
     }
 
 
-def add_xp(app: Flask, user_id: int, points: int, action: str) -> int:
+def apply_xp(conn: sqlite3.Connection, user_id: int, points: int, action: str) -> int:
+    """Grant XP inside the caller's open transaction and return the new total."""
     safe_points = max(int(points), 0)
-    conn = get_db_connection(app)
-    conn.execute("UPDATE users SET xp = xp + ? WHERE id = ?", (safe_points, user_id))
+    current = conn.execute(
+        "UPDATE users SET xp = xp + ? WHERE id = ? RETURNING xp",
+        (safe_points, user_id),
+    ).fetchone()
     conn.execute(
-        "INSERT INTO xp_events (user_id, action, points, date) VALUES (?, ?, ?, ?)",
-        (user_id, action, safe_points, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")),
+        f"INSERT INTO xp_events (user_id, action, points, date) VALUES (?, ?, ?, {SQL_UTC_NOW})",
+        (user_id, action, safe_points),
     )
-    current = conn.execute("SELECT xp FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.commit()
-    conn.close()
     return int(current["xp"]) if current else 0
 
 
+def sync_xp_caches(user_id: int, new_xp: int) -> None:
+    _leaderboard_cache.clear()
+    cached = session.get("user")
+    if cached and cached.get("id") == user_id:
+        session["user"] = {**cached, "xp": new_xp}
+
+
+def add_xp(app: Flask, user_id: int, points: int, action: str) -> int:
+    conn = get_db()
+    with write_transaction(conn):
+        new_xp = apply_xp(conn, user_id, points, action)
+    sync_xp_caches(user_id, new_xp)
+    return new_xp
+
+
 def get_user_xp_events(app: Flask, user_id: int, limit: int = 20):
-    conn = get_db_connection(app)
-    rows = conn.execute(
-        """
-        SELECT action, points, date
-        FROM xp_events
-        WHERE user_id = ?
-        ORDER BY id DESC
-        LIMIT ?
-        """,
-        (user_id, limit),
-    ).fetchall()
-    conn.close()
+    conn = get_db()
+    rows = conn.execute(XP_EVENTS_SQL, (user_id, limit)).fetchall()
     return rows
 
 
 def get_leaderboard(app: Flask, limit: int = 20):
-    conn = get_db_connection(app)
-    users = conn.execute(
-        "SELECT username, avatar, xp FROM users ORDER BY xp DESC, id ASC LIMIT ?",
-        (limit,),
-    ).fetchall()
-    conn.close()
-
-    leaderboard = []
-    rank = 0
-    previous_xp = None
-    for idx, row in enumerate(users, start=1):
-        if previous_xp != row["xp"]:
-            rank = idx
-            previous_xp = row["xp"]
-        leaderboard.append(
-            {
-                "rank": rank,
-                "username": row["username"],
-                "avatar": row["avatar"],
-                "xp": int(row["xp"]),
-                "level": get_level_info(int(row["xp"])),
-            }
-        )
+    cached = _leaderboard_cache.get(limit)
+    if cached is not None:
+        return cached
+
+    conn = get_db()
+    users = conn.execute(LEADERBOARD_SQL, (limit,)).fetchall()
+
+    leaderboard = [
+        {
+            "rank": row["rank"],
+            "username": row["username"],
+            "avatar": row["avatar"],
+            "xp": int(row["xp"]),
+            "level": get_level_info(int(row["xp"])),
+        }
+        for row in users
+    ]
+    _leaderboard_cache.set(limit, leaderboard)
     return leaderboard
 
 
-def generate_pdf(title: str, lines: list[str]) -> bytes:
+def generate_pdf(title: str, lines: Iterable[str]) -> bytes:
     buffer = io.BytesIO()
     pdf = canvas.Canvas(buffer, pagesize=A4)
     width, height = A4
@@ -300,9 +584,7 @@ def generate_pdf(title: str, lines: list[str]) -> bytes:
     pdf.setFont("Helvetica", 10)
 
     for raw_line in lines:
-        line = raw_line or ""
-        chunks = [line[i:i + 100] for i in range(0, len(line), 100)] or [""]
-        for chunk in chunks:
+        for chunk in textwrap.wrap(raw_line or "", width=100) or [""]:
             if y < 50:
                 pdf.showPage()
                 pdf.setFont("Helvetica", 10)
@@ -315,14 +597,62 @@ def generate_pdf(title: str, lines: list[str]) -> bytes:
     return buffer.read()
 
 
+def export_etag(*parts) -> str:
+    raw = "|".join(str(part) for part in parts).encode()
+    return hashlib.blake2b(raw, digest_size=8).hexdigest()
+
+
+def pdf_response(data: bytes, filename: str, etag: str) -> Response:
+    response = Response(
+        data,
+        mimetype="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+    response.set_etag(etag)
+    return response
+
+
+def not_modified(etag: str) -> Response:
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
 def strip_html(text: str) -> str:
-    return re.sub(r"<[^>]*>", "", text or "")
+    return _HTML_TAG_RE.sub("", text or "")
+
+
+def allow_request(client_key: str, limit: int) -> bool:
+    """GCRA check: allow up to ``limit`` requests per window, tracked per client."""
+    emission_interval = REQUEST_WINDOW_SECONDS / max(limit, 1)
+    shard = hash(client_key) % RATE_LIMIT_SHARDS
+    tats = _rate_limit_tats[shard]
+    now = time.monotonic()
+
+    with _rate_limit_locks[shard]:
+        tat = max(tats.get(client_key, now), now)
+        if tat - now > REQUEST_WINDOW_SECONDS - emission_interval:
+            return False
+
+        tats[client_key] = tat + emission_interval
+        tats.move_to_end(client_key)
+        if len(tats) > RATE_LIMIT_MAX_CLIENTS // RATE_LIMIT_SHARDS:
+            tats.popitem(last=False)
+    return True
 
 
 def register_hooks(app: Flask) -> None:
+    app.teardown_appcontext(release_db)
+
     @app.before_request
     def load_logged_user():
+        g.user = None
+        g.level_info = None
+        if request.endpoint == "static":
+            return
         g.user = get_current_user(app)
+        if g.user:
+            g.level_info = get_level_info(int(g.user["xp"]))
 
     @app.before_request
     def basic_rate_limit():
@@ -330,19 +660,8 @@ def register_hooks(app: Flask) -> None:
             return None
 
         client_ip = request.headers.get("X-Forwarded-For", request.remote_addr or "local")
-        now = datetime.utcnow().timestamp()
-        limit = app.config["RATE_LIMIT_PER_MINUTE"]
-
-        with REQUEST_LOCK:
-            history = REQUEST_HISTORY[client_ip]
-            while history and now - history[0] > REQUEST_WINDOW_SECONDS:
-                history.popleft()
-
-            if len(history) >= limit:
-                return jsonify({"error": "Too many requests. Please retry shortly."}), 429
-
-            history.append(now)
-
+        if not allow_request(client_ip, app.config["RATE_LIMIT_PER_MINUTE"]):
+            return jsonify({"error": "Too many requests. Please retry shortly."}), 429
         return None
 
     @app.after_request
@@ -355,9 +674,7 @@ def register_hooks(app: Flask) -> None:
 
     @app.context_processor
     def inject_user_level():
-        user = getattr(g, "user", None)
-        level = get_level_info(int(user["xp"])) if user else None
-        return {"current_level": level, "level_for_xp": get_level_info}
+        return {"current_level": getattr(g, "level_info", None), "level_for_xp": get_level_info}
 
 
 def get_gemini_client():
@@ -370,15 +687,40 @@ def get_gemini_client():
     return _gemini_client
 
 
+def get_http_session() -> requests.Session:
+    global _http_session
+    if _http_session is None:
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0)
+        http.mount("https://", adapter)
+        http.mount("http://", adapter)
+        http.headers.update({"User-Agent": "ai-study-buddy/1.0"})
+        _http_session = http
+    return _http_session
+
+
+def stop_at_deadline(retry_state) -> bool:
+    """Stop retrying once the next attempt would start after the caller's deadline."""
+    deadline = retry_state.kwargs["deadline"]
+    return time.monotonic() + retry_state.upcoming_sleep >= deadline
+
+
+def attempt_timeout(timeout: int, deadline: float) -> float:
+    return max(min(timeout, deadline - time.monotonic()), 1)
+
+
 @retry(
-    stop=stop_after_attempt(3),
+    stop=stop_after_attempt(3) | stop_at_deadline,
     wait=wait_exponential(multiplier=1, min=1, max=4),
     retry=retry_if_exception_type((requests.RequestException, RuntimeError)),
 )
-def ask_gemini(prompt: str) -> str:
+def ask_gemini(prompt: str, timeout: int, *, deadline: float) -> str:
     response = get_gemini_client().models.generate_content(
         model="models/gemini-flash-latest",
         contents=prompt,
+        config=genai_types.GenerateContentConfig(
+            http_options=genai_types.HttpOptions(timeout=int(attempt_timeout(timeout, deadline) * 1000)),
+        ),
     )
     text = (response.text or "").strip()
     if not text:
@@ -387,16 +729,16 @@ def ask_gemini(prompt: str) -> str:
 
 
 @retry(
-    stop=stop_after_attempt(3),
+    stop=stop_after_attempt(3) | stop_at_deadline,
     wait=wait_exponential(multiplier=1, min=1, max=4),
     retry=retry_if_exception_type((requests.RequestException, RuntimeError)),
 )
-def ask_openrouter(prompt: str, timeout: int) -> str:
+def ask_openrouter(prompt: str, timeout: int, *, deadline: float) -> str:
     api_key = os.getenv("OPENROUTER_API_KEY")
     if not api_key:
         raise RuntimeError("OpenRouter API key missing")
 
-    response = requests.post(
+    response = get_http_session().post(
         url="https://openrouter.ai/api/v1/chat/completions",
         headers={
             "Authorization": f"Bearer {api_key}",
@@ -406,7 +748,7 @@ def ask_openrouter(prompt: str, timeout: int) -> str:
             "model": os.getenv("OPENROUTER_MODEL", "openai/gpt-3.5-turbo"),
             "messages": [{"role": "user", "content": prompt}],
         },
-        timeout=timeout,
+        timeout=attempt_timeout(timeout, deadline),
     )
     response.raise_for_status()
     data = response.json()
@@ -449,14 +791,15 @@ Topic:
     return f"Explain clearly in structured, easy language:\n{topic}"
 
 
+@lru_cache(maxsize=512)
 def sanitize_markdown(text: str) -> str:
     rendered = markdown.markdown(text)
-    return bleach.clean(
-        rendered,
-        tags=["p", "strong", "em", "ul", "ol", "li", "code", "pre", "blockquote", "h1", "h2", "h3", "h4", "hr", "br"],
-        attributes={},
-        strip=True,
-    )
+    return nh3.clean(rendered, tags=MARKDOWN_ALLOWED_TAGS, attributes={"*": set()})
+
+
+def next_motivation_quote() -> str:
+    with _quote_lock:
+        return next(_quote_cycle)
 
 
 def local_guidance_response(message: str) -> str:
@@ -478,9 +821,9 @@ def extract_linkedin_profile_text(url: str, timeout: int) -> str:
     if "linkedin.com" not in normalized.lower():
         raise ValueError("Please provide a valid LinkedIn URL.")
 
-    no_scheme = re.sub(r"^https?://", "", normalized, flags=re.IGNORECASE)
+    no_scheme = _URL_SCHEME_RE.sub("", normalized)
     mirror_url = f"https://r.jina.ai/http://{no_scheme}"
-    response = requests.get(mirror_url, timeout=timeout)
+    response = get_http_session().get(mirror_url, timeout=timeout)
     response.raise_for_status()
     text = (response.text or "").strip()
 
@@ -490,7 +833,11 @@ def extract_linkedin_profile_text(url: str, timeout: int) -> str:
 
 
 def get_owner_profile(app: Flask, user_id: int) -> dict:
-    conn = get_db_connection(app)
+    cached = _owner_profile_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    conn = get_db()
     row = conn.execute(
         """
         SELECT owner_name, linkedin_url, linkedin_summary, owner_strengths, owner_achievements
@@ -499,46 +846,48 @@ def get_owner_profile(app: Flask, user_id: int) -> dict:
         """,
         (user_id,),
     ).fetchone()
-    conn.close()
 
     if not row:
-        return {
+        owner_profile = {
             "owner_name": DEFAULT_OWNER_NAME,
             "linkedin_url": "",
             "linkedin_summary": "",
             "owner_strengths": "focused, consistent, disciplined learner",
             "owner_achievements": "keeps improving every day",
         }
+    else:
+        owner_profile = {
+            "owner_name": DEFAULT_OWNER_NAME,
+            "linkedin_url": (row["linkedin_url"] or "").strip()[:300],
+            "linkedin_summary": (row["linkedin_summary"] or "").strip()[:4000],
+            "owner_strengths": (row["owner_strengths"] or "").strip()[:400],
+            "owner_achievements": (row["owner_achievements"] or "").strip()[:400],
+        }
 
-    return {
-        "owner_name": DEFAULT_OWNER_NAME,
-        "linkedin_url": (row["linkedin_url"] or "").strip()[:300],
-        "linkedin_summary": (row["linkedin_summary"] or "").strip()[:4000],
-        "owner_strengths": (row["owner_strengths"] or "").strip()[:400],
-        "owner_achievements": (row["owner_achievements"] or "").strip()[:400],
-    }
+    _owner_profile_cache.set(user_id, owner_profile)
+    return owner_profile
 
 
-def get_user_profile_customization(app: Flask, user_id: int) -> dict:
-    conn = get_db_connection(app)
+def get_user_with_profile_customization(app: Flask, user_id: int):
+    conn = get_db()
     row = conn.execute(
         """
-        SELECT role, bio, learning_goal
-        FROM user_profiles
-        WHERE user_id = ?
+        SELECT u.id, u.username, u.avatar, u.xp, p.role, p.bio, p.learning_goal
+        FROM users u
+        LEFT JOIN user_profiles p ON p.user_id = u.id
+        WHERE u.id = ?
         """,
         (user_id,),
     ).fetchone()
-    conn.close()
 
     if not row:
-        return {
+        return None, {
             "role": "",
             "bio": "",
             "learning_goal": "",
         }
 
-    return {
+    return row, {
         "role": (row["role"] or "").strip()[:80],
         "bio": (row["bio"] or "").strip()[:300],
         "learning_goal": (row["learning_goal"] or "").strip()[:300],
@@ -571,19 +920,8 @@ def build_owner_praise(owner_profile: dict) -> tuple[str, str]:
 def canned_assistant_response(message: str, username: str, owner_profile: dict) -> str:
     text = message.lower().strip()
     owner_name, praise = build_owner_praise(owner_profile)
-    owner_keywords = [
-        "kishan",
-        "owner",
-        "creator",
-        "who made",
-        "who built",
-        "about you",
-        "about owner",
-        "about kishan",
-        "linkedin",
-    ]
 
-    if any(keyword in text for keyword in owner_keywords):
+    if _OWNER_KEYWORD_RE.search(text):
         linkedin_url = (owner_profile.get("linkedin_url") or "").strip()
         owner_summary = strip_html(owner_profile.get("linkedin_summary") or "").strip()
         summary_line = owner_summary.splitlines()[0].strip() if owner_summary else ""
@@ -597,55 +935,9 @@ def canned_assistant_response(message: str, username: str, owner_profile: dict)
             answer += f"\nLinkedIn: {linkedin_url}"
         return answer
 
-    faq_rules = [
-        (
-            ["hello", "hi", "hey"],
-            f"Hi {username}! 👋 I’m your Study Buddy. Ask me about chat, XP, quiz, PDF, leaderboard, or profile settings.",
-        ),
-        (
-            ["how to use", "how use", "start", "guide", "help"],
-            (
-                f"Sure {username}, quick guide:\n"
-                "1) Open AI Chat and enter a prompt.\n"
-                "2) Pick mode (Explain/Summarize/Quiz/Flashcards).\n"
-                "3) Optionally upload PDF and click Analyze PDF.\n"
-                "4) Use Dashboard for stats/history.\n"
-                "5) Use XP Center to track progress and rules."
-            ),
-        ),
-        (
-            ["xp", "points", "level", "badge"],
-            (
-                f"{username}, XP is earned on tasks and quiz submits.\n"
-                "- Explain +8\n- Summarize +10\n- Flashcards +12\n- Quiz generate +15\n"
-                "- PDF bonus +5\n- Quiz submit base +20\n- +5 per correct answer"
-            ),
-        ),
-        (
-            ["leaderboard", "rank", "ranking"],
-            f"{username}, open Leaderboard from sidebar to see XP ranking. Higher XP means better rank 🏆.",
-        ),
-        (
-            ["quiz", "mcq", "test"],
-            f"{username}, select Quiz mode in Chat, generate questions, then submit. You earn extra XP based on correct answers.",
-        ),
-        (
-            ["pdf", "file", "upload"],
-            f"{username}, in Chat use the file picker, then click Analyze PDF. You’ll also get PDF bonus XP ✨.",
-        ),
-        (
-            ["theme", "dark", "light", "mode"],
-            f"{username}, use the 🌓 Toggle Theme button in the sidebar to switch Dark/Light mode.",
-        ),
-        (
-            ["profile", "password", "avatar"],
-            f"{username}, open Profile page to change avatar and password settings.",
-        ),
-    ]
-
-    for keywords, response in faq_rules:
-        if any(keyword in text for keyword in keywords):
-            return response
+    matched_rules = {_FAQ_KEYWORD_RULE[match.group(1)] for match in _FAQ_KEYWORD_RE.finditer(text)}
+    if matched_rules:
+        return FAQ_RULES[min(matched_rules)][1].format(username=username)
 
     return (
         f"{username}, I didn’t fully catch that, but I can still guide you.\n"
@@ -654,40 +946,30 @@ def canned_assistant_response(message: str, username: str, owner_profile: dict)
     )
 
 
-def run_with_timeout(callable_fn, timeout_seconds: float):
-    result = {}
-    error = {}
+def ai_response_cache_key(topic: str, mode: str, difficulty: str, provider: str) -> str:
+    raw_key = f"{provider}|{mode}|{difficulty}|{topic}".encode()
+    return hashlib.blake2b(raw_key, digest_size=16).hexdigest()
 
-    def worker():
-        try:
-            result["value"] = callable_fn()
-        except Exception as exc:
-            error["error"] = exc
-
-    thread = threading.Thread(target=worker, daemon=True)
-    thread.start()
-    thread.join(timeout_seconds)
-
-    if thread.is_alive():
-        raise TimeoutError("Operation timed out")
-    if "error" in error:
-        raise error["error"]
-    return result.get("value")
 
+def generate_ai_response(topic: str, mode: str, difficulty: str, provider: str, timeout: int, deadline: float):
+    """Ask the selected provider, falling back to the other one, until the monotonic deadline passes."""
+    if time.monotonic() >= deadline:
+        raise TimeoutError("AI request expired while queued")
 
-def generate_ai_response(topic: str, mode: str, difficulty: str, provider: str, timeout: int):
     prompt = build_prompt(topic, mode, difficulty)
     selected_provider = provider if provider in ALLOWED_PROVIDERS else "gemini"
     warning = None
 
     def call_provider(engine: str):
         if engine == "openrouter":
-            return ask_openrouter(prompt, timeout)
-        return ask_gemini(prompt)
+            return ask_openrouter(prompt, timeout, deadline=deadline)
+        return ask_gemini(prompt, timeout, deadline=deadline)
 
     try:
         raw_response = call_provider(selected_provider)
     except Exception:
+        if time.monotonic() >= deadline:
+            raise TimeoutError("AI request deadline passed before fallback")
         alternate = "openrouter" if selected_provider == "gemini" else "gemini"
         raw_response = call_provider(alternate)
         warning = f"⚠️ {selected_provider.title()} unavailable. Switched to {alternate.title()} backup."
@@ -703,47 +985,27 @@ def extract_pdf_text(pdf_file) -> str:
     if not pdf_file.filename.lower().endswith(".pdf"):
         raise ValueError("Only PDF files are supported")
 
-    reader = PdfReader(pdf_file)
+    reader = PdfReader(pdf_file, strict=False)
     chunks = []
+    collected = 0
     for page in reader.pages:
-        chunks.append((page.extract_text() or "").strip())
-    return "\n".join(part for part in chunks if part).strip()[:12000]
+        text = (page.extract_text() or "").strip()
+        if not text:
+            continue
+        chunks.append(text)
+        collected += len(text) + 1
+        if collected >= MAX_PDF_TEXT_LENGTH:
+            break
+    return "\n".join(chunks)[:MAX_PDF_TEXT_LENGTH]
 
 
-def build_dashboard_data(app: Flask, user_id: int, q: str):
-    conn = get_db_connection(app)
-    params = [user_id]
-    sql_filter = "WHERE user_id = ?"
-    if q:
-        sql_filter += " AND topic LIKE ?"
-        params.append(f"%{q}%")
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 
-    rows = conn.execute(
-        f"""
-        SELECT topic, score, total, difficulty, provider, date
-        FROM quiz_scores
-        {sql_filter}
-        ORDER BY id DESC
-        LIMIT 30
-        """,
-        tuple(params),
-    ).fetchall()
 
-    stats = conn.execute(
-        """
-        SELECT
-            COUNT(*) as attempts,
-            COALESCE(SUM(score), 0) as total_score,
-            COALESCE(SUM(total), 0) as total_questions,
-            COALESCE(AVG(CASE WHEN total > 0 THEN (score * 100.0 / total) END), 0) as avg_percent
-        FROM quiz_scores
-        WHERE user_id = ?
-        """,
-        (user_id,),
-    ).fetchone()
-    conn.close()
-
-    return rows, {
+def build_dashboard_stats(app: Flask, user_id: int) -> dict:
+    stats = get_db().execute(DASHBOARD_STATS_SQL, (user_id,)).fetchone()
+    return {
         "attempts": int(stats["attempts"]),
         "total_score": int(stats["total_score"]),
         "total_questions": int(stats["total_questions"]),
@@ -751,6 +1013,39 @@ def build_dashboard_data(app: Flask, user_id: int, q: str):
     }
 
 
+def build_dashboard_data(app: Flask, user_id: int, q: str):
+    conn = get_db()
+    if q:
+        rows = conn.execute(HISTORY_SEARCH_SQL, (user_id, f"%{escape_like(q)}%", DASHBOARD_ROW_LIMIT)).fetchall()
+    else:
+        rows = conn.execute(HISTORY_SQL, (user_id, DASHBOARD_ROW_LIMIT)).fetchall()
+    return rows, build_dashboard_stats(app, user_id)
+
+
+def check_database_health() -> str:
+    db_status = _db_health_cache.get("database")
+    if db_status is None:
+        try:
+            get_db().execute("SELECT 1")
+            db_status = "ok"
+        except Exception:
+            db_status = "error"
+        _db_health_cache.set("database", db_status)
+    return db_status
+
+
+def build_health_payload(app: Flask) -> dict:
+    db_status = check_database_health()
+    return {
+        "status": "ok" if db_status == "ok" else "degraded",
+        "database": db_status,
+        "gemini_configured": bool(os.getenv("GEMINI_API_KEY")),
+        "openrouter_configured": bool(os.getenv("OPENROUTER_API_KEY")),
+        "authenticated": bool(g.user),
+        "timestamp": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+    }
+
+
 def register_routes(app: Flask) -> None:
     @app.get("/")
     def root():
@@ -777,25 +1072,26 @@ def register_routes(app: Flask) -> None:
             if avatar not in AVATARS:
                 avatar = AVATARS[0]
 
-            conn = get_db_connection(app)
+            conn = get_db()
+            # Hash before BEGIN IMMEDIATE so scrypt doesn't run while holding the write lock.
+            password_hash = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
             try:
-                conn.execute(
-                    "INSERT INTO users (username, password_hash, avatar, xp, created_at) VALUES (?, ?, ?, ?, ?)",
-                    (
-                        username,
-                        generate_password_hash(password, method="pbkdf2:sha256"),
-                        avatar,
-                        0,
-                        datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                    ),
-                )
-                conn.commit()
+                with write_transaction(conn):
+                    conn.execute(
+                        "INSERT INTO users (username, password_hash, avatar, xp, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (
+                            username,
+                            password_hash,
+                            avatar,
+                            0,
+                            utc_timestamp(),
+                        ),
+                    )
+                _leaderboard_cache.clear()
                 flash("Account created. Please log in.", "success")
                 return redirect(url_for("login"))
             except sqlite3.IntegrityError:
                 flash("Username already exists. Try another one.", "error")
-            finally:
-                conn.close()
 
         return render_template("signup.html", avatars=AVATARS, selected_avatar=AVATARS[0])
 
@@ -808,16 +1104,23 @@ def register_routes(app: Flask) -> None:
             username = (request.form.get("username") or "").strip()
             password = request.form.get("password") or ""
 
-            conn = get_db_connection(app)
+            conn = get_db()
             user = conn.execute(
-                "SELECT id, username, password_hash FROM users WHERE username = ?",
+                "SELECT id, username, avatar, xp, password_hash FROM users WHERE username = ?",
                 (username,),
             ).fetchone()
-            conn.close()
 
             if user and check_password_hash(user["password_hash"], password):
+                if not user["password_hash"].startswith(f"{PASSWORD_HASH_METHOD}:"):
+                    password_hash = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+                    with write_transaction(conn):
+                        conn.execute(
+                            "UPDATE users SET password_hash = ? WHERE id = ?",
+                            (password_hash, user["id"]),
+                        )
                 session.clear()
                 session["user_id"] = user["id"]
+                remember_session_user(user)
                 flash(f"Welcome back, {user['username']}!", "success")
                 return redirect(url_for("chat"))
 
@@ -837,14 +1140,16 @@ def register_routes(app: Flask) -> None:
     def profile():
         if request.method == "POST":
             action = request.form.get("action", "avatar")
-            conn = get_db_connection(app)
+            conn = get_db()
 
             if action == "avatar":
                 avatar = request.form.get("avatar") or AVATARS[0]
                 if avatar not in AVATARS:
                     avatar = AVATARS[0]
-                conn.execute("UPDATE users SET avatar = ? WHERE id = ?", (avatar, g.user["id"]))
-                conn.commit()
+                with write_transaction(conn):
+                    conn.execute("UPDATE users SET avatar = ? WHERE id = ?", (avatar, g.user["id"]))
+                session["user"] = {**g.user, "avatar": avatar}
+                _leaderboard_cache.clear()
                 flash("Avatar updated successfully.", "success")
 
             elif action == "password":
@@ -860,11 +1165,12 @@ def register_routes(app: Flask) -> None:
                 elif len(new_password) < 6:
                     flash("New password must be at least 6 characters.", "error")
                 else:
-                    conn.execute(
-                        "UPDATE users SET password_hash = ? WHERE id = ?",
-                        (generate_password_hash(new_password, method="pbkdf2:sha256"), g.user["id"]),
-                    )
-                    conn.commit()
+                    password_hash = generate_password_hash(new_password, method=PASSWORD_HASH_METHOD)
+                    with write_transaction(conn):
+                        conn.execute(
+                            "UPDATE users SET password_hash = ? WHERE id = ?",
+                            (password_hash, g.user["id"]),
+                        )
                     flash("Password updated successfully.", "success")
 
             elif action == "owner_ai":
@@ -881,30 +1187,31 @@ def register_routes(app: Flask) -> None:
                     except Exception as err:
                         flash(str(err), "error")
 
-                conn.execute(
-                    """
-                    INSERT INTO owner_profiles (
-                        user_id, owner_name, linkedin_url, linkedin_summary, owner_strengths, owner_achievements, updated_at
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(user_id) DO UPDATE SET
-                        owner_name=excluded.owner_name,
-                        linkedin_url=excluded.linkedin_url,
-                        linkedin_summary=excluded.linkedin_summary,
-                        owner_strengths=excluded.owner_strengths,
-                        owner_achievements=excluded.owner_achievements,
-                        updated_at=excluded.updated_at
-                    """,
-                    (
-                        g.user["id"],
-                        owner_name,
-                        linkedin_url,
-                        linkedin_summary,
-                        owner_strengths,
-                        owner_achievements,
-                        datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                    ),
-                )
-                conn.commit()
+                with write_transaction(conn):
+                    conn.execute(
+                        """
+                        INSERT INTO owner_profiles (
+                            user_id, owner_name, linkedin_url, linkedin_summary, owner_strengths, owner_achievements, updated_at
+                        ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                            owner_name=excluded.owner_name,
+                            linkedin_url=excluded.linkedin_url,
+                            linkedin_summary=excluded.linkedin_summary,
+                            owner_strengths=excluded.owner_strengths,
+                            owner_achievements=excluded.owner_achievements,
+                            updated_at=excluded.updated_at
+                        """,
+                        (
+                            g.user["id"],
+                            owner_name,
+                            linkedin_url,
+                            linkedin_summary,
+                            owner_strengths,
+                            owner_achievements,
+                            utc_timestamp(),
+                        ),
+                    )
+                _owner_profile_cache.pop(g.user["id"])
                 flash("Owner chatbot memory updated.", "success")
 
             elif action == "personalize":
@@ -912,32 +1219,32 @@ def register_routes(app: Flask) -> None:
                 bio = (request.form.get("bio") or "").strip()[:300]
                 learning_goal = (request.form.get("learning_goal") or "").strip()[:300]
 
-                conn.execute(
-                    """
-                    INSERT INTO user_profiles (user_id, role, bio, learning_goal, updated_at)
-                    VALUES (?, ?, ?, ?, ?)
-                    ON CONFLICT(user_id) DO UPDATE SET
-                        role=excluded.role,
-                        bio=excluded.bio,
-                        learning_goal=excluded.learning_goal,
-                        updated_at=excluded.updated_at
-                    """,
-                    (
-                        g.user["id"],
-                        role,
-                        bio,
-                        learning_goal,
-                        datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                    ),
-                )
-                conn.commit()
+                with write_transaction(conn):
+                    conn.execute(
+                        """
+                        INSERT INTO user_profiles (user_id, role, bio, learning_goal, updated_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                            role=excluded.role,
+                            bio=excluded.bio,
+                            learning_goal=excluded.learning_goal,
+                            updated_at=excluded.updated_at
+                        """,
+                        (
+                            g.user["id"],
+                            role,
+                            bio,
+                            learning_goal,
+                            utc_timestamp(),
+                        ),
+                    )
                 flash("Profile personalization saved.", "success")
 
-            conn.close()
             return redirect(url_for("profile"))
 
-        refreshed_user = get_current_user(app)
-        user_profile_custom = get_user_profile_customization(app, g.user["id"])
+        refreshed_user, user_profile_custom = get_user_with_profile_customization(app, g.user["id"])
+        if refreshed_user:
+            remember_session_user(refreshed_user)
         return render_template(
             "profile.html",
             user=refreshed_user,
@@ -962,7 +1269,6 @@ def register_routes(app: Flask) -> None:
             difficulty = request.form.get("difficulty", "Easy")
             provider = request.form.get("provider", "gemini")
             action = request.form.get("action", "generate")
-            pdf_file = request.files.get("pdf_file")
 
             if mode not in ALLOWED_MODES:
                 mode = "explain"
@@ -972,7 +1278,7 @@ def register_routes(app: Flask) -> None:
                 provider = "gemini"
 
             try:
-                pdf_text = extract_pdf_text(pdf_file) if action == "pdf" else ""
+                pdf_text = extract_pdf_text(request.files.get("pdf_file")) if action == "pdf" else ""
             except ValueError as err:
                 flash(str(err), "error")
                 pdf_text = ""
@@ -983,17 +1289,34 @@ def register_routes(app: Flask) -> None:
             if not user_input:
                 flash("Please enter prompt text or upload a PDF to analyze.", "error")
             else:
+                cache_key = ai_response_cache_key(user_input, mode, difficulty, provider)
+                cacheable = mode in CACHEABLE_MODES
                 try:
-                    response_text, provider, api_warning, raw_response = generate_ai_response(
-                        topic=user_input,
-                        mode=mode,
-                        difficulty=difficulty,
-                        provider=provider,
-                        timeout=app.config["REQUEST_TIMEOUT"],
-                    )
+                    result = _ai_response_cache.get(cache_key) if cacheable else None
+                    cache_hit = result is not None
+                    if not cache_hit:
+                        # One budget covers queueing, retries and the fallback provider.
+                        deadline = time.monotonic() + app.config["AI_RESPONSE_BUDGET"]
+                        future = app.extensions["ai_executor"].submit(
+                            generate_ai_response,
+                            topic=user_input,
+                            mode=mode,
+                            difficulty=difficulty,
+                            provider=provider,
+                            timeout=app.config["REQUEST_TIMEOUT"],
+                            deadline=deadline,
+                        )
+                        result = future.result(timeout=max(deadline - time.monotonic(), 0))
+                    response_text, provider, api_warning, raw_response = result
+                    if cacheable and not cache_hit and api_warning is None:
+                        _ai_response_cache.set(cache_key, result)
                     earned = XP_RULES.get(mode, 8) + (XP_RULES["pdf_bonus"] if action == "pdf" else 0)
                     current_xp = add_xp(app, g.user["id"], earned, f"chat_{mode}_{action}")
                     flash(f"+{earned} XP earned. Total XP: {current_xp}", "success")
+                except TimeoutError:
+                    future.cancel()
+                    app.logger.warning("AI generation timed out after %ss", app.config["AI_RESPONSE_BUDGET"])
+                    response_text = "⚠️ AI service is taking too long to respond. Please try again in a moment."
                 except Exception:
                     app.logger.exception("AI generation failed")
                     response_text = "⚠️ AI service temporarily unavailable. Please try again in a moment."
@@ -1014,7 +1337,7 @@ def register_routes(app: Flask) -> None:
             provider=provider,
             api_warning=api_warning,
             leaderboard=leaderboard,
-            level_info=get_level_info(int(g.user["xp"])),
+            level_info=g.level_info,
         )
 
     @app.get("/dashboard")
@@ -1030,19 +1353,19 @@ def register_routes(app: Flask) -> None:
             stats=stats,
             query=query,
             leaderboard=leaderboard,
-            level_info=get_level_info(int(g.user["xp"])),
+            level_info=g.level_info,
         )
 
     @app.get("/leaderboard")
     @login_required
     def leaderboard_page():
         leaderboard = get_leaderboard(app, 50)
-        return render_template("leaderboard.html", user=g.user, leaderboard=leaderboard, level_info=get_level_info(int(g.user["xp"])))
+        return render_template("leaderboard.html", user=g.user, leaderboard=leaderboard, level_info=g.level_info)
 
     @app.get("/xp-center")
     @login_required
     def xp_center():
-        level_info = get_level_info(int(g.user["xp"]))
+        level_info = g.level_info
         events = get_user_xp_events(app, g.user["id"], 25)
         leaderboard = get_leaderboard(app, 10)
         return render_template(
@@ -1073,27 +1396,18 @@ def register_routes(app: Flask) -> None:
         if total <= 0 or score < 0 or score > total:
             return jsonify({"error": "Invalid score range"}), 400
 
-        conn = get_db_connection(app)
-        conn.execute(
-            """
-            INSERT INTO quiz_scores (user_id, topic, score, total, difficulty, provider, date)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                g.user["id"],
-                topic or "Untitled topic",
-                score,
-                total,
-                difficulty,
-                provider,
-                datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-            ),
-        )
-        conn.commit()
-        conn.close()
-
         gained = XP_RULES["quiz_submit_base"] + (score * XP_RULES["per_correct_answer"])
-        current_xp = add_xp(app, g.user["id"], gained, "quiz_submit")
+        conn = get_db()
+        with write_transaction(conn):
+            conn.execute(
+                f"""
+                INSERT INTO quiz_scores (user_id, topic, score, total, difficulty, provider, date)
+                VALUES (?, ?, ?, ?, ?, ?, {SQL_UTC_NOW})
+                """,
+                (g.user["id"], topic or "Untitled topic", score, total, difficulty, provider),
+            )
+            current_xp = apply_xp(conn, g.user["id"], gained, "quiz_submit")
+        sync_xp_caches(g.user["id"], current_xp)
         return jsonify({"status": "saved", "xp_gained": gained, "total_xp": current_xp})
 
     @app.post("/api/assistant")
@@ -1112,7 +1426,7 @@ def register_routes(app: Flask) -> None:
                 "reply": canned_assistant_response(message, username, owner_profile),
                 "provider": "local-faq",
                 "warning": None,
-                "quote": random.choice(MOTIVATION_QUOTES),
+                "quote": next_motivation_quote(),
             }
         )
 
@@ -1122,45 +1436,20 @@ def register_routes(app: Flask) -> None:
         limit = min(max(int(request.args.get("limit", 10)), 1), 100)
         q = (request.args.get("q") or "").strip()
 
-        params = [g.user["id"]]
-        filter_clause = "WHERE user_id = ?"
+        cursor = get_db().cursor()
+        cursor.row_factory = None
         if q:
-            filter_clause += " AND topic LIKE ?"
-            params.append(f"%{q}%")
-
-        conn = get_db_connection(app)
-        rows = conn.execute(
-            """
-            SELECT topic, score, total, difficulty, provider, date
-            FROM quiz_scores
-            """
-            + filter_clause
-            +
-            """
-            ORDER BY id DESC
-            LIMIT ?
-            """,
-            tuple(params + [limit]),
-        ).fetchall()
-        conn.close()
-
-        return jsonify([
-            {
-                "topic": row["topic"],
-                "score": row["score"],
-                "total": row["total"],
-                "difficulty": row["difficulty"],
-                "provider": row["provider"],
-                "date": row["date"],
-            }
-            for row in rows
-        ])
+            cursor.execute(HISTORY_SEARCH_SQL, (g.user["id"], f"%{escape_like(q)}%", limit))
+        else:
+            cursor.execute(HISTORY_SQL, (g.user["id"], limit))
+        rows = cursor.fetchall()
+
+        return jsonify([dict(zip(HISTORY_COLUMNS, row)) for row in rows])
 
     @app.get("/api/stats")
     @login_required
     def stats():
-        rows, data = build_dashboard_data(app, g.user["id"], "")
-        _ = rows
+        data = build_dashboard_stats(app, g.user["id"])
         data["xp"] = int(g.user["xp"])
         return jsonify(data)
 
@@ -1172,33 +1461,27 @@ def register_routes(app: Flask) -> None:
     @app.get("/export_scores.pdf")
     @login_required
     def export_scores_pdf():
-        conn = get_db_connection(app)
-        rows = conn.execute(
-            """
-            SELECT topic, score, total, difficulty, provider, date
-            FROM quiz_scores
-            WHERE user_id = ?
-            ORDER BY id DESC
-            """,
-            (g.user["id"],),
-        ).fetchall()
-        conn.close()
-
-        lines = [f"User: {g.user['username']} ({g.user['avatar']})", f"XP: {g.user['xp']}", ""]
-        if not rows:
-            lines.append("No score entries found.")
-        else:
+        conn = get_db()
+        max_id = conn.execute("SELECT MAX(id) FROM quiz_scores WHERE user_id = ?", (g.user["id"],)).fetchone()[0]
+        etag = export_etag(g.user["id"], max_id, g.user["xp"], g.user["username"], g.user["avatar"])
+        if etag in request.if_none_match:
+            return not_modified(etag)
+
+        rows = conn.execute(SCORE_EXPORT_SQL, (g.user["id"],))
+
+        def report_lines() -> Iterator[str]:
+            yield f"User: {g.user['username']} ({g.user['avatar']})"
+            yield f"XP: {g.user['xp']}"
+            yield ""
+            empty = True
             for row in rows:
-                lines.append(
-                    f"{row['date']} | {row['topic']} | Score {row['score']}/{row['total']} | {row['difficulty']} | {row['provider'] or '-'}"
-                )
-
-        data = generate_pdf("AI Study Buddy Score Report", lines)
-        return Response(
-            data,
-            mimetype="application/pdf",
-            headers={"Content-Disposition": "attachment; filename=quiz_scores.pdf"},
-        )
+                empty = False
+                yield f"{row['date']} | {row['topic']} | Score {row['score']}/{row['total']} | {row['difficulty']} | {row['provider'] or '-'}"
+            if empty:
+                yield "No score entries found."
+
+        data = generate_pdf("AI Study Buddy Score Report", report_lines())
+        return pdf_response(data, "quiz_scores.pdf", etag)
 
     @app.get("/export_response.pdf")
     @login_required
@@ -1210,39 +1493,21 @@ def register_routes(app: Flask) -> None:
             flash("No generated response available yet. Use Chat first.", "error")
             return redirect(url_for("chat"))
 
-        lines = [f"Mode: {mode}", f"Prompt: {topic}", "", *strip_html(response_text).splitlines()]
+        etag = export_etag(mode, topic, response_text)
+        if etag in request.if_none_match:
+            return not_modified(etag)
+
+        lines = itertools.chain((f"Mode: {mode}", f"Prompt: {topic}", ""), strip_html(response_text).splitlines())
         data = generate_pdf("AI Study Buddy Generated Response", lines)
-        return Response(
-            data,
-            mimetype="application/pdf",
-            headers={"Content-Disposition": "attachment; filename=study_response.pdf"},
-        )
+        return pdf_response(data, "study_response.pdf", etag)
 
     @app.get("/health")
     def health_page():
-        payload = healthz().get_json()
-        return render_template("health.html", user=g.user, health=payload)
+        return render_template("health.html", user=g.user, health=build_health_payload(app))
 
     @app.get("/healthz")
     def healthz():
-        db_status = "ok"
-        try:
-            conn = get_db_connection(app)
-            conn.execute("SELECT 1")
-            conn.close()
-        except Exception:
-            db_status = "error"
-
-        return jsonify(
-            {
-                "status": "ok" if db_status == "ok" else "degraded",
-                "database": db_status,
-                "gemini_configured": bool(os.getenv("GEMINI_API_KEY")),
-                "openrouter_configured": bool(os.getenv("OPENROUTER_API_KEY")),
-                "authenticated": bool(g.user),
-                "timestamp": datetime.utcnow().isoformat() + "Z",
-            }
-        )
+        return jsonify(build_health_payload(app))
 
 
 app = create_app()
@@ -2,7 +2,9 @@ import os
 
 bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
 workers = int(os.getenv("WEB_CONCURRENCY", "2"))
-threads = int(os.getenv("GUNICORN_THREADS", "2"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+# The app sizes its AI executor (AI_MAX_WORKERS) from GUNICORN_THREADS, so the two stay in step.
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
 timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
 graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
 keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
@@ -1,20 +1,41 @@
 import os
 import tempfile
+import time
 import unittest
 import uuid
+from unittest import mock
+
+from flask import g, session
+from werkzeug.security import generate_password_hash
 
 TEST_DB_PATH = os.path.join(tempfile.gettempdir(), "ai_study_buddy_test.db")
 os.environ["DATABASE_FILE"] = TEST_DB_PATH
 os.environ["FLASK_SECRET_KEY"] = "test-secret"
 
-from app import create_app  # noqa: E402
+from app import (  # noqa: E402
+    HISTORY_SEARCH_SQL,
+    HISTORY_SQL,
+    LEADERBOARD_SQL,
+    SCORE_EXPORT_SQL,
+    XP_EVENTS_SQL,
+    TTLCache,
+    allow_request,
+    create_app,
+    generate_ai_response,
+    get_db,
+)
+
+
+def remove_test_db():
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(TEST_DB_PATH + suffix):
+            os.remove(TEST_DB_PATH + suffix)
 
 
 class AppRoutesTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        if os.path.exists(TEST_DB_PATH):
-            os.remove(TEST_DB_PATH)
+        remove_test_db()
 
         cls.app = create_app()
         cls.app.config["TESTING"] = True
@@ -22,8 +43,7 @@ class AppRoutesTestCase(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
-        if os.path.exists(TEST_DB_PATH):
-            os.remove(TEST_DB_PATH)
+        remove_test_db()
 
     def setUp(self):
         with self.client.session_transaction() as sess:
@@ -36,6 +56,65 @@ class AppRoutesTestCase(unittest.TestCase):
         self.assertIn("status", data)
         self.assertIn("database", data)
 
+        page = self.client.get("/health")
+        self.assertEqual(page.status_code, 200)
+
+    def test_db_connection_is_reused_per_thread(self):
+        with self.app.app_context():
+            conn = get_db()
+            self.assertIs(conn, get_db())
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        with self.app.app_context():
+            self.assertIs(conn, get_db())
+
+    def test_init_db_collects_planner_statistics(self):
+        with self.app.app_context():
+            stat_table = get_db().execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+            ).fetchone()
+            self.assertIsNotNone(stat_table)
+
+    def test_user_history_queries_use_composite_index(self):
+        with self.app.app_context():
+            conn = get_db()
+            for sql, params in (
+                (HISTORY_SQL, (1, 30)),
+                (HISTORY_SEARCH_SQL, (1, "%math%", 30)),
+                (XP_EVENTS_SQL, (1, 20)),
+                (SCORE_EXPORT_SQL, (1,)),
+            ):
+                plan = " ".join(row["detail"] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+                self.assertIn("(user_id=?)", plan)
+                self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_leaderboard_query_reads_xp_index_without_sorting(self):
+        with self.app.app_context():
+            plan = " ".join(
+                row["detail"]
+                for row in get_db().execute(f"EXPLAIN QUERY PLAN {LEADERBOARD_SQL}", (50,))
+            )
+        self.assertIn("USING INDEX idx_users_xp", plan)
+        self.assertIn("USING COVERING INDEX idx_users_xp (xp>?)", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_rate_limiter_blocks_after_limit(self):
+        key = f"client_{uuid.uuid4().hex[:8]}"
+        self.assertTrue(all(allow_request(key, 3) for _ in range(3)))
+        self.assertFalse(allow_request(key, 3))
+        self.assertTrue(allow_request(f"{key}_other", 3))
+
+    def test_ttl_cache_expires_and_evicts(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), 3)
+
+        expired = TTLCache(maxsize=2, ttl=0)
+        expired.set("a", 1)
+        self.assertIsNone(expired.get("a"))
+
     def _signup_and_login(self, username=None, password="secret123", avatar="🧠"):
         if username is None:
             username = f"user_{uuid.uuid4().hex[:8]}"
@@ -54,6 +133,30 @@ class AppRoutesTestCase(unittest.TestCase):
         self.assertEqual(login.status_code, 302)
         return username, password
 
+    def test_login_upgrades_legacy_password_hash(self):
+        username = f"user_{uuid.uuid4().hex[:8]}"
+        with self.app.app_context():
+            conn = get_db()
+            with conn:
+                conn.execute(
+                    "INSERT INTO users (username, password_hash, avatar, xp, created_at) VALUES (?, ?, ?, 0, ?)",
+                    (username, generate_password_hash("secret123", method="pbkdf2:sha256"), "🧠", "2024-01-01 00:00:00"),
+                )
+
+        login = self.client.post("/login", data={"username": username, "password": "secret123"})
+        self.assertEqual(login.status_code, 302)
+
+        with self.app.app_context():
+            stored = get_db().execute("SELECT password_hash FROM users WHERE username = ?", (username,)).fetchone()
+        self.assertTrue(stored["password_hash"].startswith("scrypt:"))
+
+    def test_static_requests_skip_user_lookup(self):
+        with self.app.test_request_context("/static/app.css"):
+            session["user_id"] = 1
+            self.app.preprocess_request()
+            self.assertIsNone(g.user)
+            self.assertNotIn("db", g)
+
     def test_private_score_endpoints_require_login(self):
         self.assertEqual(self.client.get("/chat").status_code, 302)
         self.assertEqual(self.client.get("/dashboard").status_code, 302)
@@ -114,6 +217,7 @@ class AppRoutesTestCase(unittest.TestCase):
         self.assertIn("Data Analyst", html)
         self.assertIn("Loves math and AI projects.", html)
         self.assertIn("Master statistics this month", html)
+        self.assertIn("Current level: 🥉 Bronze", html)
 
     def test_save_score_and_private_stats_history_export(self):
         self._signup_and_login()
@@ -134,12 +238,15 @@ class AppRoutesTestCase(unittest.TestCase):
         self.assertEqual(stats.status_code, 200)
         stats_data = stats.get_json()
         self.assertGreaterEqual(stats_data["attempts"], 1)
+        self.assertEqual(stats_data["xp"], save.get_json()["total_xp"])
 
         history = self.client.get("/api/history?limit=5&q=Geo")
         self.assertEqual(history.status_code, 200)
         history_data = history.get_json()
         self.assertTrue(isinstance(history_data, list))
         self.assertGreaterEqual(len(history_data), 1)
+        self.assertEqual(history_data[0]["topic"], "Geometry")
+        self.assertEqual(history_data[0]["score"], 4)
 
         leaderboard = self.client.get("/api/leaderboard")
         self.assertEqual(leaderboard.status_code, 200)
@@ -152,6 +259,127 @@ class AppRoutesTestCase(unittest.TestCase):
         export = self.client.get("/export_scores.pdf")
         self.assertEqual(export.status_code, 200)
         self.assertEqual(export.mimetype, "application/pdf")
+        self.assertIsNotNone(export.get_etag()[0])
+
+        cached_export = self.client.get("/export_scores.pdf", headers={"If-None-Match": export.headers["ETag"]})
+        self.assertEqual(cached_export.status_code, 304)
+
+    def test_topic_search_treats_wildcards_literally(self):
+        self._signup_and_login()
+        for topic in ("Algebra 100% basics", "Trigonometry"):
+            save = self.client.post(
+                "/save_score",
+                data={"topic": topic, "score": "3", "total": "5", "difficulty": "Easy", "provider": "gemini"},
+            )
+            self.assertEqual(save.status_code, 200)
+
+        literal = self.client.get("/dashboard?q=100%25").get_data(as_text=True)
+        self.assertIn("Algebra 100% basics", literal)
+        self.assertNotIn("Trigonometry", literal)
+
+        wildcard = self.client.get("/dashboard?q=_").get_data(as_text=True)
+        self.assertNotIn("Algebra 100% basics", wildcard)
+        self.assertNotIn("Trigonometry", wildcard)
+
+        history = self.client.get("/api/history?q=100%25").get_json()
+        self.assertEqual([row["topic"] for row in history], ["Algebra 100% basics"])
+        self.assertEqual(self.client.get("/api/history?q=_").get_json(), [])
+
+    def test_chat_reports_timeout_when_ai_is_slow(self):
+        self._signup_and_login()
+
+        def slow_response(**_kwargs):
+            time.sleep(0.5)
+            return "late", "gemini", None, "late"
+
+        with mock.patch("app.generate_ai_response", side_effect=slow_response), mock.patch.dict(
+            self.app.config, {"AI_RESPONSE_BUDGET": 0.05}
+        ):
+            response = self.client.post("/chat", data={"topic": "Photosynthesis", "mode": "explain"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("taking too long", response.get_data(as_text=True))
+
+    def test_ai_response_stops_retrying_at_deadline(self):
+        gemini = mock.Mock(side_effect=RuntimeError("Gemini returned empty response"))
+        with mock.patch("app.get_gemini_client") as client, mock.patch("app.ask_openrouter", return_value="Backup") as backup:
+            client.return_value.models.generate_content = gemini
+            output, provider, warning, _ = generate_ai_response(
+                "Osmosis", "explain", "Easy", "gemini", timeout=25, deadline=time.monotonic() + 0.5
+            )
+
+        self.assertEqual(gemini.call_count, 1)
+        backup.assert_called_once()
+        self.assertEqual(provider, "openrouter")
+        self.assertIn("Backup", output)
+        self.assertIsNotNone(warning)
+
+        with mock.patch("app.ask_gemini") as primary, self.assertRaises(TimeoutError):
+            generate_ai_response("Osmosis", "explain", "Easy", "gemini", timeout=25, deadline=time.monotonic() - 1)
+        primary.assert_not_called()
+
+    def test_chat_reuses_cached_ai_response(self):
+        self._signup_and_login()
+        topic = f"Cell biology {uuid.uuid4().hex[:8]}"
+        fake = mock.Mock(return_value=("<p>Cells</p>", "gemini", None, "Cells"))
+
+        with mock.patch("app.generate_ai_response", fake):
+            for _ in range(2):
+                response = self.client.post("/chat", data={"topic": topic, "mode": "explain"})
+                self.assertEqual(response.status_code, 200)
+                self.assertIn("<p>Cells</p>", response.get_data(as_text=True))
+
+        self.assertEqual(fake.call_count, 1)
+
+    def test_chat_regenerates_quiz_for_repeated_topic(self):
+        self._signup_and_login()
+        topic = f"Cell biology {uuid.uuid4().hex[:8]}"
+        fake = mock.Mock(return_value=("Q1. What is a cell?", "gemini", None, "Q1. What is a cell?"))
+
+        with mock.patch("app.generate_ai_response", fake):
+            for _ in range(2):
+                response = self.client.post("/chat", data={"topic": topic, "mode": "quiz"})
+                self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(fake.call_count, 2)
+
+    def test_chat_strips_html_attributes_from_ai_output(self):
+        self._signup_and_login()
+        raw = '<p title="tip-xyz" lang="fr-xyz" onclick="steal()">Mitochondria</p>'
+
+        with mock.patch("app.ask_gemini", return_value=raw):
+            response = self.client.post(
+                "/chat", data={"topic": f"Organelles {uuid.uuid4().hex[:8]}", "mode": "explain"}
+            )
+
+        body = response.get_data(as_text=True)
+        self.assertIn("<p>Mitochondria</p>", body)
+        for leaked in ("tip-xyz", "fr-xyz", "steal()"):
+            self.assertNotIn(leaked, body)
+
+    def test_owner_profile_update_refreshes_assistant_reply(self):
+        self._signup_and_login()
+        question = {"message": "Tell me about Kishan and his LinkedIn"}
+
+        before = self.client.post("/api/assistant", json=question).get_json()
+        self.assertNotIn("LinkedIn: https://", before["reply"])
+
+        new_url = f"https://www.linkedin.com/in/owner-{uuid.uuid4().hex[:8]}"
+        save_owner = self.client.post(
+            "/profile",
+            data={
+                "action": "owner_ai",
+                "linkedin_url": new_url,
+                "owner_strengths": "focused, disciplined, helpful",
+                "owner_achievements": "consistent learner",
+                "linkedin_summary": "Builder and continuous learner",
+            },
+            follow_redirects=False,
+        )
+        self.assertEqual(save_owner.status_code, 302)
+
+        after = self.client.post("/api/assistant", json=question).get_json()
+        self.assertIn(f"LinkedIn: {new_url}", after["reply"])
 
     def test_assistant_api_returns_guidance(self):
         self._signup_and_login()